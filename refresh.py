@@ -3,14 +3,15 @@
 """
 Dynamic Spotify playlist refresher with:
 - 60/40 familiar/discovery
-- novelty tracked across runs (persisted in repo: state/seen.json, state/history.csv)
+- novelty tracked across runs (persisted in repo: state/seen.ndjson, state/history.csv)
 - robust logging + markdown/JSON report + NDJSON event stream under reports/<ts>/
 - resilient recs with widening and graceful fallbacks
 - zero reliance on audio-features (to avoid 403 spikes)
 """
 
-import os, sys, json, math, time, random, datetime, pathlib, csv, traceback
-from typing import List, Dict, Any, Optional, Set, Tuple
+import os, sys, json, math, time, random, datetime, pathlib, csv, traceback, functools, itertools, threading, atexit
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, Any, Optional, Set, Tuple
 
 # -------------------------------
 # Environment & Config
@@ -60,14 +61,35 @@ TARGET_ENERGY   = (MIN_ENERGY + MAX_ENERGY) / 2.0
 SEEN_MAX     = env_int("SEEN_MAX", 10000)        # cap the seen list to last 10k items (sliding)
 NOVELTY_DAYS = env_int("NOVELTY_DAYS", 3650)     # consider anything ever-seen as "seen" (10y). Tune if you want decay.
 
+# Concurrency for independent read-only API calls (network-bound; threads release the GIL on socket I/O)
+MAX_WORKERS  = env_int("MAX_WORKERS", 6)
+MAX_INFLIGHT = env_int("MAX_INFLIGHT", 5)        # hard cap on simultaneous HTTP requests (rate-limit safety)
+RETRY_BUDGET = env_float("RETRY_BUDGET", 60.0)   # max seconds one call may spend sleeping on 429/5xx
+RATE_LIMIT_RPS = env_float("RATE_LIMIT_RPS", 20.0) # token-bucket request rate, below Spotify's rolling limit (0 disables)
+
 # State & Reports dirs (committed back to repo by workflow)
 STATE_DIR   = pathlib.Path("state")
 REPORTS_DIR = pathlib.Path("reports")
 
+# Local cache (restored across workflow runs via actions/cache; never committed)
+CACHE_DIR   = pathlib.Path(env_str("CACHE_DIR", ".spotify_cache"))
+
+PLAYABLE_TTL = env_int("PLAYABLE_TTL", 7 * 86400)  # per-track market availability verdicts
+
 STATE_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
 REPORTS_DIR.mkdir(parents=True, exist_ok=True)
 
-RUN_TS = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+def utc_now() -> datetime.datetime:
+    # aware UTC (datetime.utcnow() is deprecated since 3.12)
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def iso_z(dt: datetime.datetime) -> str:
+    # keep the historical "...Z" form: seen-run timestamps are compared as text
+    return dt.replace(tzinfo=None).isoformat() + "Z"
+
+RUN_START = utc_now()  # one clock read shared by the run dir, report and seen log
+RUN_TS = RUN_START.strftime("%Y%m%d_%H%M%S")
 RUN_DIR = REPORTS_DIR / RUN_TS
 RUN_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -82,7 +104,7 @@ logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO),
 log = logging.getLogger("dp-refresh")
 
 RUN: Dict[str, Any] = {
-    "started_utc": datetime.datetime.utcnow().isoformat() + "Z",
+    "started_utc": iso_z(RUN_START),
     "env": {
         "PLAYLIST_ID": PLAYLIST_ID,
         "MARKET": MARKET,
@@ -101,7 +123,8 @@ RUN: Dict[str, Any] = {
     },
     "exclusions": {
         "seen_excluded": 0,
-        "already_in_playlist": 0
+        "already_in_playlist": 0,
+        "unplayable": 0
     },
     "api_warnings": [],
     "seeds": {"artists": [], "tracks": [], "genres": []},
@@ -112,10 +135,36 @@ RUN: Dict[str, Any] = {
     "final_track_ids": [],
 }
 
+try:
+    import orjson  # optional C codec for reports, events and state files; stdlib json otherwise
+except ImportError:
+    orjson = None
+
+def json_line(obj: Any) -> str:
+    # compact one-line JSON + newline (an NDJSON row)
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8") + "\n"
+    return json.dumps(obj, separators=(",", ":")) + "\n"
+
+def json_pretty(obj: Any) -> str:
+    # human-facing report (2-space indent either way)
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode("utf-8")
+    return json.dumps(obj, indent=2)
+
+def json_parse(text: str) -> Any:
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+# one handle for the whole run, line-buffered so a killed/timed-out run keeps every event
+# written so far; events come from worker threads too
+EVENTS_FH = (RUN_DIR / "events.ndjson").open("a", encoding="utf-8", buffering=1)
+EVENTS_LOCK = threading.Lock()
+atexit.register(EVENTS_FH.close)
+
 def event(where: str, **kv):
-    with (RUN_DIR / "events.ndjson").open("a", encoding="utf-8") as f:
-        row = {"where": where, **kv}
-        f.write(json.dumps(row) + "\n")
+    line = json_line({"where": where, **kv})
+    with EVENTS_LOCK:
+        EVENTS_FH.write(line)
 
 def warn_api(where: str, err: Exception):
     msg = f"{type(err).__name__}: {err}"
@@ -125,8 +174,7 @@ def warn_api(where: str, err: Exception):
 
 def write_reports():
     # JSON
-    with (RUN_DIR / "report.json").open("w", encoding="utf-8") as f:
-        json.dump(RUN, f, indent=2)
+    (RUN_DIR / "report.json").write_text(json_pretty(RUN), encoding="utf-8")
 
     # Markdown
     md = []
@@ -151,135 +199,368 @@ def write_reports():
     with final_csv.open("w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(["track_id", "source_bucket"])
-        for tid, src in RUN["_final_sources"]:
-            w.writerow([tid, src])
+        w.writerows(RUN.get("_final_sources", []))
 
     print(f"REPORT_DIR={RUN_DIR}")  # visible in logs for workflow to pick up
 
+# -------------------------------
+# Local cache (slow-moving reads)
+# -------------------------------
+
+def write_atomic(path: pathlib.Path, text: str):
+    # write-then-rename so a concurrent reader never sees a half-written file
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+def cache_get(key: str, ttl: int) -> Optional[Any]:
+    path = CACHE_DIR / f"{key}.json"
+    if ttl <= 0 or not path.exists():
+        return None
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except Exception as e:
+        warn_api(f"cache_get[{key}]", e)
+        return None
+    if time.time() - data.get("ts", 0) > ttl:
+        return None
+    event("cache_hit", key=key)
+    return data.get("value")
+
+def cache_set(key: str, value: Any):
+    try:
+        write_atomic(CACHE_DIR / f"{key}.json", json.dumps({"ts": time.time(), "value": value}))
+    except Exception as e:
+        warn_api(f"cache_set[{key}]", e)
+
 # -------------------------------
 # Spotify client
 # -------------------------------
 # We use spotipy with refresh-token flow. No client creds or auth-code during the job.
 
+import requests
 import spotipy
+from requests.adapters import HTTPAdapter
+from spotipy.exceptions import SpotifyException
 from spotipy.oauth2 import SpotifyOAuth
+from urllib3.util.retry import Retry
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: sustained `rate` requests/sec, bursts up to `burst`.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class BoundedSession(requests.Session):
+    """
+    requests.Session that caps in-flight requests and paces them through a
+    token bucket, so concurrent fan-out (nested pools included) bursts freely
+    up to the budget but cannot exceed Spotify's rate limit.
+    """
+    def __init__(self, max_inflight: int, limiter: Optional[RateLimiter] = None):
+        super().__init__()
+        self._slots = threading.BoundedSemaphore(max(1, max_inflight))
+        self._limiter = limiter
+
+    def request(self, *args, **kwargs):
+        with self._slots:
+            if self._limiter:
+                self._limiter.acquire()
+            return super().request(*args, **kwargs)
+
+def http_session() -> requests.Session:
+    # One long-lived keep-alive pool for every API call (no TCP+TLS handshake per request).
+    # The adapter only retries failed connects (the request never left); 429/5xx are
+    # api_call's job, so it sees the real status and Retry-After instead of spotipy's
+    # synthetic "Max Retries" 429 after a second, hidden retry cycle.
+    # read=False (as in spotipy's own session): a read timeout may follow a POST the server
+    # already applied, and re-sending playlist_add_items would duplicate tracks
+    retry = Retry(
+        total=3, connect=3, read=False, backoff_factor=0.5,
+        status_forcelist=(), respect_retry_after_header=False,
+    )
+    limiter = RateLimiter(RATE_LIMIT_RPS, burst=max(1, MAX_INFLIGHT)) if RATE_LIMIT_RPS > 0 else None
+    session = BoundedSession(MAX_INFLIGHT, limiter)
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+    return session
 
 def sp_client() -> spotipy.Spotify:
+    # one pooled, retrying session for the token refresh and every API call after it
+    session = http_session()
     scope = "playlist-read-private playlist-modify-private playlist-modify-public user-top-read user-library-read"
     auth = SpotifyOAuth(
         client_id=SPOTIFY_CLIENT_ID,
         client_secret=SPOTIFY_CLIENT_SECRET,
         redirect_uri="https://example.com/callback",
         scope=scope,
-        cache_path=None
+        cache_path=None,
+        requests_session=session,
+        requests_timeout=20
     )
     # monkey-patch token cache with refresh_token we already have
     auth.refresh_token = SPOTIFY_REFRESH_TOKEN
     token_info = auth.refresh_access_token(SPOTIFY_REFRESH_TOKEN)
-    sp = spotipy.Spotify(auth=token_info["access_token"], requests_timeout=20, retries=3, status_forcelist=(429, 500, 502, 503, 504))
+    sp = spotipy.Spotify(auth=token_info["access_token"], requests_session=session, requests_timeout=20)
     return sp
 
+def retry_after(headers: Optional[Dict[str, str]]) -> float:
+    # seconds form only; an HTTP-date or junk value falls back to 1s rather than raising
+    try:
+        return max(0.0, float((headers or {}).get("Retry-After")))
+    except (TypeError, ValueError):
+        return 1.0
+
+def api_call(where: str, fn, *args, default: Any = None, retry_5xx: bool = True, **kwargs) -> Any:
+    """
+    Call a spotipy method, returning `default` (after warn_api) on failure.
+    The only retry layer for HTTP errors: a 429 sleeps Retry-After (+ jitter)
+    and retries, 5xx backs off exponentially (capped), other 4xx fail fast.
+    At most 5 retries, and total sleep per call is bounded by RETRY_BUDGET.
+    Pass retry_5xx=False for non-idempotent writes: a 502/504 may arrive after
+    Spotify applied the request, whereas a 429 never is.
+    """
+    waited, attempt = 0.0, 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except SpotifyException as e:
+            status = e.http_status or 0
+            if status == 429 and not e.headers:
+                delay = None  # spotipy's synthetic "Max Retries" 429: a retry layer already gave up
+            elif status == 429:
+                delay = retry_after(e.headers) + random.uniform(0, 0.5)
+            elif status >= 500 and retry_5xx:
+                delay = min(30.0, 0.5 * 2 ** attempt) + random.random() * 0.3
+            else:
+                delay = None
+            attempt += 1
+            if delay is None or attempt > 5 or waited + delay > RETRY_BUDGET:
+                warn_api(where, e)
+                return default
+            log.info("[%s] HTTP %s, retrying in %.1fs", where, status, delay)
+            time.sleep(delay)
+            waited += delay
+        except Exception as e:
+            warn_api(where, e)
+            return default
+
 # -------------------------------
 # Helpers (IDs, pagers, unique)
 # -------------------------------
 
 def uniq(a: List[str]) -> List[str]:
-    s, out = set(), []
-    for x in a:
-        if x and x not in s:
-            s.add(x); out.append(x)
-    return out
+    # order-preserving dedupe (dicts keep insertion order); filter + hashing both run in C
+    return list(dict.fromkeys(filter(None, a)))
+
+def ids_of(objs: List[Dict[str, Any]]) -> List[str]:
+    # IDs of plain API objects (artists, recommended tracks); skips null entries with one lookup each
+    return [i for o in objs if o and (i := o.get("id"))]
 
 def track_ids_from_items(items: List[Dict[str, Any]]) -> List[str]:
-    out = []
-    for it in items:
-        # Supports both track objects and playlist track wrappers
-        track = it.get("track", it)
-        if track and track.get("id"):
-            out.append(track["id"])
-    return out
+    # Supports both track objects and playlist track wrappers; one comprehension, no per-item appends
+    return [i for it in items if it and (t := it.get("track", it)) and (i := t.get("id"))]
+
+def playlist_page(sp: spotipy.Spotify, playlist_id: str, offset: int) -> Dict[str, Any]:
+    return api_call(f"playlist_items[{offset}]", sp.playlist_items, playlist_id,
+                    fields="items(track(id)),total", additional_types=("track",),
+                    limit=100, offset=offset, default={}) or {}
+
+def paginate_all(fetch: Callable[[int], Dict[str, Any]], page_size: int, max_items: int) -> List[Dict[str, Any]]:
+    """
+    Offset-paged read: page 0 reports `total`, so every remaining offset is known
+    up front and fetched concurrently instead of following `next` one round trip
+    at a time. `fetch(offset)` returns a page dict ({} on failure); items keep order.
+    """
+    first = fetch(0)
+    items = list(first.get("items", []) or [])
+    offsets = range(page_size, min(int(first.get("total") or 0), max_items), page_size)
+    if offsets:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            for page in pool.map(fetch, offsets):
+                items.extend(page.get("items", []) or [])
+    return items
 
 def playlist_track_ids(sp: spotipy.Spotify, playlist_id: str, limit: int = 1000) -> List[str]:
-    out = []
-    offset = 0
-    while True:
-        try:
-            page = sp.playlist_items(playlist_id, fields="items(track(id)),next", additional_types=("track",), limit=100, offset=offset)
-        except Exception as e:
-            warn_api("playlist_items", e); break
-        items = page.get("items", []) or []
-        out.extend(track_ids_from_items(items))
-        if not page.get("next") or len(out) >= limit:
-            break
-        offset += 100
-    return out
+    return track_ids_from_items(paginate_all(lambda o: playlist_page(sp, playlist_id, o), 100, limit))
 
 def current_user_top(sp: spotipy.Spotify, time_range: str) -> List[str]:
-    try:
-        res = sp.current_user_top_tracks(limit=50, time_range=time_range)
-        return track_ids_from_items(res.get("items", []) or [])
-    except Exception as e:
-        warn_api(f"current_user_top_tracks[{time_range}]", e)
-        return []
+    res = api_call(f"current_user_top_tracks[{time_range}]", sp.current_user_top_tracks,
+                   limit=50, time_range=time_range, default={}) or {}
+    return track_ids_from_items(res.get("items", []) or [])
 
 def current_user_top_artists(sp: spotipy.Spotify, time_range: str) -> List[str]:
-    try:
-        res = sp.current_user_top_artists(limit=50, time_range=time_range)
-        ids = [a["id"] for a in (res.get("items", []) or []) if a and a.get("id")]
-        return ids
-    except Exception as e:
-        warn_api(f"current_user_top_artists[{time_range}]", e)
-        return []
+    res = api_call(f"current_user_top_artists[{time_range}]", sp.current_user_top_artists,
+                   limit=50, time_range=time_range, default={}) or {}
+    return ids_of(res.get("items", []) or [])
+
+def saved_page(sp: spotipy.Spotify, offset: int) -> Dict[str, Any]:
+    return api_call(f"current_user_saved_tracks[{offset}]", sp.current_user_saved_tracks,
+                    limit=50, offset=offset, default={}) or {}
 
 def saved_tracks(sp: spotipy.Spotify, max_take: int = 200) -> List[str]:
-    out, offset = [], 0
-    # user-library-read scope required; we handle 403 gracefully
-    while len(out) < max_take:
-        try:
-            page = sp.current_user_saved_tracks(limit=50, offset=offset)
-        except Exception as e:
-            warn_api("current_user_saved_tracks", e); break
-        items = page.get("items", []) or []
-        out.extend(track_ids_from_items(items))
-        if len(items) < 50:
-            break
-        offset += 50
-    return out[:max_take]
+    # user-library-read scope required; we handle 403 gracefully (empty first page -> no fan-out)
+    return track_ids_from_items(paginate_all(lambda o: saved_page(sp, o), 50, max_take))[:max_take]
+
+def playable_ids(sp: spotipy.Spotify, ids: List[str], market: str) -> List[str]:
+    """
+    Keep only IDs playable in `market`, checked in bulk (50 per /v1/tracks call).
+    Verdicts are remembered per track for PLAYABLE_TTL, so carried-over and
+    recurring familiar tracks are not re-checked every run. A failed batch is
+    kept as-is (and not remembered) rather than emptying the playlist.
+    """
+    key = f"playable_{market}"
+    now = time.time()
+    known: Dict[str, List[Any]] = {
+        t: v for t, v in (cache_get(key, PLAYABLE_TTL) or {}).items() if now - v[1] <= PLAYABLE_TTL
+    }
+
+    def check(batch: List[str]) -> Optional[Set[str]]:
+        res = api_call("tracks[playable]", sp.tracks, batch, market=market)
+        if res is None:
+            return None
+        ok = set()
+        for t in res.get("tracks", []) or []:
+            if t and t.get("is_playable", True):
+                # relinked tracks report the requested ID under linked_from
+                ok.add((t.get("linked_from") or {}).get("id") or t.get("id"))
+        return ok
+
+    # dedupe before batching so a repeated ID never costs a second lookup
+    unknown = [t for t in uniq(ids) if t not in known]
+    batches = [unknown[i:i+50] for i in range(0, len(unknown), 50)]
+    failed: Set[str] = set()
+    if batches:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            for batch, ok in zip(batches, pool.map(check, batches)):
+                if ok is None:
+                    failed.update(batch)
+                    continue
+                for t in batch:
+                    known[t] = [t in ok, now]
+        cache_set(key, known)
+    return [t for t in ids if t in failed or known[t][0]]
 
 # -------------------------------
 # State persistence (seen/history)
 # -------------------------------
 
-SEEN_PATH    = STATE_DIR / "seen.json"
+SEEN_PATH        = STATE_DIR / "seen.ndjson"  # append-only, one run per line: {"ts","tracks","n"}
+LEGACY_SEEN_PATH = STATE_DIR / "seen.json"    # pre-NDJSON store: read only while seen.ndjson is absent, never deleted
+SEEN_COMPACT_BYTES = 512 * 1024               # rewrite (drop stale runs) once the log grows past this
 HISTORY_PATH = STATE_DIR / "history.csv"
 
-def load_seen() -> List[str]:
-    if SEEN_PATH.exists():
-        try:
-            return json.loads(SEEN_PATH.read_text(encoding="utf-8"))
-        except Exception as e:
-            warn_api("load_seen", e)
-    return []
+def novelty_cutoff() -> str:
+    # run timestamps are ISO-8601 UTC strings, so they compare correctly as text
+    return iso_z(RUN_START - datetime.timedelta(days=NOVELTY_DAYS))
+
+def cap_runs(runs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # sliding window: drop oldest runs until at most SEEN_MAX IDs remain
+    total = sum(len(r.get("tracks", [])) for r in runs)
+    start = 0  # find the cut point, then slice once (no list copy per dropped run)
+    while start < len(runs) and total > SEEN_MAX:
+        total -= len(runs[start].get("tracks", []))
+        start += 1
+    return runs[start:]
+
+def load_legacy_seen() -> List[Dict[str, Any]]:
+    if not LEGACY_SEEN_PATH.exists():
+        return []
+    try:
+        data = json.loads(LEGACY_SEEN_PATH.read_text(encoding="utf-8"))
+    except Exception as e:
+        warn_api("load_seen[legacy]", e)
+        return []
+    if isinstance(data, list):
+        # flat list of IDs (no timestamps): keep it as one run dated now
+        return [{"ts": RUN["started_utc"], "tracks": data, "n": len(data)}]
+    return data.get("runs", []) or []
 
-def save_seen(seen_ids: List[str]):
-    # cap sliding window
-    if len(seen_ids) > SEEN_MAX:
-        seen_ids = seen_ids[-SEEN_MAX:]
+_TS_PREFIX = '{"ts":"'  # json_line() writes "ts" first, so a run's timestamp is readable without parsing
+
+def line_ts(line: str) -> Optional[str]:
+    if not line.startswith(_TS_PREFIX):
+        return None
+    end = line.find('"', len(_TS_PREFIX))
+    return line[len(_TS_PREFIX):end] if end > 0 else None
+
+def seen_set(runs: List[Dict[str, Any]]) -> Set[str]:
+    # C-level union over the runs' track lists (no per-ID Python loop)
+    return set().union(*(r.get("tracks", ()) for r in runs))
+
+def load_seen() -> Tuple[List[Dict[str, Any]], Set[str]]:
+    """
+    Runs still inside the NOVELTY_DAYS window, oldest first: [{"ts", "tracks", "n"}, ...],
+    plus the set of every track ID in them. Stale runs are dropped in the same
+    pass that reads them, before their track arrays are ever decoded.
+    """
+    cutoff = novelty_cutoff()
+    if not SEEN_PATH.exists():
+        runs = cap_runs([r for r in load_legacy_seen() if r.get("ts", "") >= cutoff])
+        return runs, seen_set(runs)
+    runs = []
+    fresh = False  # the log is append-only, so once one run is inside the window all later ones are
+    try:
+        with SEEN_PATH.open(encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if not fresh:
+                    ts = line_ts(line)
+                    if ts is not None and ts < cutoff:
+                        continue
+                r = json_parse(line)
+                if fresh or r.get("ts", "") >= cutoff:
+                    fresh = True
+                    runs.append(r)
+    except Exception as e:
+        warn_api("load_seen", e)
+    runs = cap_runs(runs)
+    return runs, seen_set(runs)
+
+def save_seen(runs: List[Dict[str, Any]], new_run: Dict[str, Any]):
+    """
+    Append this run as one NDJSON line. The whole log is only rewritten (stale
+    and over-cap runs dropped) when it does not exist yet (e.g. seeded from a
+    legacy seen.json) or once it passes SEEN_COMPACT_BYTES.
+    """
+    line = json_line(new_run)
     try:
-        SEEN_PATH.write_text(json.dumps(seen_ids, indent=0), encoding="utf-8")
+        if SEEN_PATH.exists() and SEEN_PATH.stat().st_size < SEEN_COMPACT_BYTES:
+            with SEEN_PATH.open("a", encoding="utf-8") as f:
+                f.write(line)
+            return
+        kept = cap_runs(runs + [new_run])
+        write_atomic(SEEN_PATH, "".join(json_line(r) for r in kept))
+        event("seen_compact", runs=len(kept))
     except Exception as e:
         warn_api("save_seen", e)
 
 def append_history(run_ts: str, final_ids: List[str], sources: List[Tuple[str, str]]):
     # sources is list of (track_id, bucket)
+    # every field is base62 / digits / a fixed bucket name, so no CSV quoting is ever needed:
+    # build the block as one string and append it with a single write
     try:
-        newfile = not HISTORY_PATH.exists()
+        header = "" if HISTORY_PATH.exists() else "run_ts,ordinal,track_id,bucket\r\n"
+        rows = "".join(f"{run_ts},{i},{tid},{bucket}\r\n" for i, (tid, bucket) in enumerate(sources, 1))
         with HISTORY_PATH.open("a", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            if newfile:
-                w.writerow(["run_ts", "ordinal", "track_id", "bucket"])
-            for i, (tid, bucket) in enumerate(sources, 1):
-                w.writerow([run_ts, i, tid, bucket])
+            f.write(header + rows)
     except Exception as e:
         warn_api("append_history", e)
 
@@ -287,128 +568,185 @@ def append_history(run_ts: str, final_ids: List[str], sources: List[Tuple[str, s
 # Discovery / Recommendations
 # -------------------------------
 
-def recs(
-    sp: spotipy.Spotify,
-    limit: int,
-    seed_artists: List[str],
-    seed_tracks: List[str],
-    energy: Tuple[float,float],
-    tempo: Tuple[float,float],
-    market: str
-) -> List[str]:
+@functools.lru_cache(maxsize=8)
+def widen_steps(energy: Tuple[float,float], tempo: Tuple[float,float]) -> Tuple[Dict[str, float], ...]:
     """
-    Get recommendations with widening if sparse.
+    Widening ladder for a window, built once per (energy, tempo) pair. Treat as read-only.
     """
     min_e, max_e = energy
     min_t, max_t = tempo
-    params_base = {
-        "limit": min(100, max(1, limit)),
-        "min_energy": max(0.0, min_e),
-        "max_energy": min(1.0, max_e),
-        "min_tempo": max(0.0, min_t),
-        "max_tempo": max_t,
-    }
-    # seed up to 5 total (artists + tracks)
-    seeds_a = seed_artists[:3]
-    seeds_t = seed_tracks[:2]
-    out: List[str] = []
-
-    widen_steps = [
+    return (
         {},  # exact window
         {"min_energy": max(0.0, min_e - 0.05), "max_energy": min(1.0, max_e + 0.05)},
         {"min_tempo": max(0.0, min_t - 6.0), "max_tempo": max_t + 6.0},
         {"min_energy": max(0.0, min_e - 0.10), "max_energy": min(1.0, max_e + 0.10),
          "min_tempo": max(0.0, min_t - 12.0), "max_tempo": max_t + 12.0},
         {"min_energy": 0.5, "max_energy": 1.0, "min_tempo": 90.0, "max_tempo": 160.0},
-    ]
+    )
 
-    tried = 0
-    for bump in widen_steps:
-        tried += 1
-        RUN["counts"]["widen_attempts"] = tried
-        params = dict(params_base)
-        params.update(bump)
-        if seeds_a:
-            params["seed_artists"] = ",".join(seeds_a)
-        if seeds_t:
-            params["seed_tracks"] = ",".join(seeds_t)
-        try:
-            r = sp.recommendations(**params)
-            items = r.get("tracks", []) or []
-            ids = [t["id"] for t in items if t and t.get("id")]
-            out.extend(ids)
-            if len(out) >= limit:
-                break
-        except Exception as e:
-            warn_api("recommendations", e)
-            continue
-    return uniq(out)[:limit]
+@functools.lru_cache(maxsize=8)
+def rec_params(energy: Tuple[float,float], tempo: Tuple[float,float], market: str) -> Dict[str, Any]:
+    """
+    Constant part of a recommendations request for a window. Treat as read-only.
+    """
+    min_e, max_e = energy
+    min_t, max_t = tempo
+    return {
+        "country": market,
+        "min_energy": max(0.0, min_e),
+        "max_energy": min(1.0, max_e),
+        "target_energy": round((min_e + max_e) / 2.0, 2),
+        "min_tempo": max(0.0, min_t),
+        "max_tempo": max_t,
+        "target_tempo": round((min_t + max_t) / 2.0, 1),
+    }
 
-def build_familiar(
+def recs(
     sp: spotipy.Spotify,
-    carry_ids: List[str],
-    target_n: int
+    limit: int,
+    seed_artists: List[str],
+    seed_tracks: List[str],
+    energy: Tuple[float,float],
+    tempo: Tuple[float,float],
+    market: str
 ) -> List[str]:
-    # Top tracks (short + medium) + saved tracks first
-    t_short = current_user_top(sp, "short_term")
-    t_med   = current_user_top(sp, "medium_term")
-    lib     = saved_tracks(sp, max_take=200)  # if scope available
+    """
+    Get recommendations with widening if sparse. Every call asks for a full
+    100-track page, so the exact window usually satisfies `limit` in one round
+    trip; if not, the wider rungs are requested two at a time, in ladder
+    order, stopping after the pair that fills `limit`. The whole
+    (deduped) result is returned so novelty filtering downstream has spare
+    candidates instead of falling through to backfill.
+    """
+    base = rec_params(energy, tempo, market)
+    # seed up to 5 total (artists + tracks); spotipy joins the lists itself
+    seeds: Dict[str, Any] = {"limit": 100}
+    if seed_artists:
+        seeds["seed_artists"] = seed_artists[:3]
+    if seed_tracks:
+        seeds["seed_tracks"] = seed_tracks[:2]
+
+    def fetch(bump: Dict[str, float]) -> List[str]:
+        r = api_call("recommendations", sp.recommendations, **{**base, **bump, **seeds})
+        return ids_of(r.get("tracks", []) or []) if r is not None else []
+
+    exact, *wider = widen_steps(energy, tempo)
+    out = fetch(exact)
+    RUN["counts"]["widen_attempts"] = 1
+    if len(out) < limit and wider:
+        # window is sparse: overlap rungs in pairs. A pair costs at most one request
+        # more than the sequential ladder, and a rung is only sent once the ones
+        # before it have come up short, so an early fill still saves the rest.
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for i in range(0, len(wider), 2):
+                for ids in pool.map(fetch, wider[i:i+2]):
+                    out.extend(ids)
+                    RUN["counts"]["widen_attempts"] += 1
+                if len(out) >= limit:
+                    break
+    return uniq(out)
 
-    pool = uniq(t_short + t_med + lib)
-    pool = [t for t in pool if t not in carry_ids]
-    random.shuffle(pool)
-    return pool[:target_n]
+def build_familiar(
+    carry_ids: List[str],
+    target_n: int,
+    t_short: List[str],
+    t_med: List[str],
+    lib: List[str],
+    keep: Optional[Callable[[List[str]], List[str]]] = None
+) -> List[str]:
+    # Top tracks (short + medium) + saved tracks; all three are prefetched concurrently by main()
+    # one pass: dedupe and drop carry without concatenating or re-scanning
+    taken = set(carry_ids)
+    pool: List[str] = []
+    for t in itertools.chain(t_short, t_med, lib):
+        if t and t not in taken:
+            taken.add(t); pool.append(t)
+    # filter (e.g. playability) before sampling, so a dropped track is replaced from the pool
+    if keep is not None:
+        pool = keep(pool)
+    return random.sample(pool, min(target_n, len(pool)))
+
+@functools.lru_cache(maxsize=8)
+def catalog_recs(sp: spotipy.Spotify, genres: Tuple[str, ...]) -> List[str]:
+    """
+    Genre-seeded recommendations for the window, one full 100-track page.
+    Memoised for the process only (backfill reuses discovery's fetch); the
+    daily cron outlives any useful cross-run TTL. Treat as read-only.
+    """
+    r = api_call(
+        "recommendations[catalog]", sp.recommendations,
+        limit=100,
+        seed_genres=list(genres),
+        country=MARKET,
+        min_energy=MIN_ENERGY, max_energy=MAX_ENERGY,
+        min_tempo=MIN_TEMPO, max_tempo=MAX_TEMPO,
+    )
+    if r is None:
+        return []
+    return ids_of(r.get("tracks", []) or [])
 
 def build_discovery(
     sp: spotipy.Spotify,
     seed_artists: List[str],
     seed_tracks: List[str],
     avoid_ids: Set[str],
-    target_n: int
+    target_n: int,
+    primary: Optional[List[str]] = None,
+    keep: Optional[Callable[[List[str]], List[str]]] = None
 ) -> List[str]:
-    # primary: recommendations from user seeds
-    ids = recs(sp, target_n * 2, seed_artists, seed_tracks,
-               energy=(MIN_ENERGY, MAX_ENERGY), tempo=(MIN_TEMPO, MAX_TEMPO),
-               market=MARKET)
-    ids = [i for i in ids if i not in avoid_ids]
+    # primary: recommendations from user seeds (main() may have prefetched them)
+    if primary is None:
+        primary = recs(sp, target_n * 2, seed_artists, seed_tracks,
+                       energy=(MIN_ENERGY, MAX_ENERGY), tempo=(MIN_TEMPO, MAX_TEMPO),
+                       market=MARKET)
+    # primary is already unique (recs() dedupes), so avoid is the only filter;
+    # `keep` runs on candidates before sampling so the spare recs can stand in for dropped ones
+    ids = [i for i in primary if i not in avoid_ids]
+    if keep is not None:
+        ids = keep(ids)
     if len(ids) >= target_n:
-        random.shuffle(ids)
-        return ids[:target_n]
+        return random.sample(ids, target_n)
 
-    # secondary: broaden with catalog fallbacks (bollywood/edm/pop)
+    # secondary: broaden with catalog fallbacks (bollywood/edm/pop), one genre query
+    # at a time so the second is only sent when the first comes up short;
+    # dedupe + avoid in the same pass instead of re-running uniq() per source
+    picked = set(ids)
     catalog_seeds = [
-        ("seed_genres", "bollywood,edm,pop"),
-        ("seed_genres", "indian-pop,edm,pop"),
+        ("bollywood", "edm", "pop"),
+        ("indian-pop", "edm", "pop"),
     ]
-    for k, v in catalog_seeds:
-        try:
-            r = sp.recommendations(
-                limit=max(10, target_n),
-                **{k: v},
-                min_energy=MIN_ENERGY, max_energy=MAX_ENERGY,
-                min_tempo=MIN_TEMPO, max_tempo=MAX_TEMPO,
-            )
-            items = r.get("tracks", []) or []
-            extra = [t["id"] for t in items if t and t.get("id")]
-            for x in extra:
-                if x not in avoid_ids:
-                    ids.append(x)
-            ids = uniq(ids)
-            if len(ids) >= target_n:
-                break
-        except Exception as e:
-            warn_api("recommendations[catalog]", e)
-            continue
+    for genres in catalog_seeds:
+        found = catalog_recs(sp, genres)
+        fresh = uniq([x for x in found if x not in avoid_ids and x not in picked])
+        if keep is not None:
+            fresh = keep(fresh)
+        picked.update(fresh); ids.extend(fresh)
+        if len(ids) >= target_n:
+            break
 
-    random.shuffle(ids)
-    return ids[:target_n]
+    return random.sample(ids, min(target_n, len(ids)))
+
+def write_playlist(sp: spotipy.Spotify, playlist_id: str, ids: List[str]) -> bool:
+    """
+    Replace playlist contents: one PUT for the first 100 IDs (the per-call max),
+    then append the rest in 100-ID chunks. The PUT resets the playlist, so no
+    separate clear pass is needed.
+    """
+    if api_call("playlist_replace_items", sp.playlist_replace_items, playlist_id, ids[:100], default=False) is False:
+        return False
+    for i in range(100, len(ids), 100):
+        # POST append is not idempotent: retry only on 429
+        if api_call("playlist_add_items", sp.playlist_add_items, playlist_id, ids[i:i+100],
+                    default=False, retry_5xx=False) is False:
+            return False
+    return True
 
 # -------------------------------
 # Main
 # -------------------------------
 
 def main() -> int:
-    print(f"Starting refresh at {datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}")
+    print(f"Starting refresh at {RUN_START.strftime('%Y-%m-%dT%H:%M:%SZ')}")
     sp = sp_client()
 
     # Window (exposed to report)
@@ -419,42 +757,81 @@ def main() -> int:
         "familiar_ratio": FAMILIAR_RATIO
     }
 
-    # 1) Read current playlist + compute carry
-    current_ids = playlist_track_ids(sp, PLAYLIST_ID) or []
+    # 1) Independent read-only fetches run concurrently: wall time ~ slowest call, not the sum
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        f_current   = pool.submit(playlist_track_ids, sp, PLAYLIST_ID)
+        f_art_short = pool.submit(current_user_top_artists, sp, "short_term")
+        f_top_short = pool.submit(current_user_top, sp, "short_term")
+        f_top_med   = pool.submit(current_user_top, sp, "medium_term")
+        f_saved     = pool.submit(saved_tracks, sp, 200)  # if scope available
+
+    # Read current playlist + compute carry
+    current_ids = f_current.result() or []
+    top_short   = f_top_short.result()  # shared by familiar pool and discovery seeds
     carry_n = max(0, min(N_TRACKS, int(math.floor(N_TRACKS * CARRY_FRACTION))))
-    carry = current_ids[:carry_n]
+
+    def keep_playable(ids: List[str]) -> List[str]:
+        # drop tracks not playable in MARKET *before* each bucket is sized/sampled,
+        # so the pools refill the gap instead of the final playlist coming up short
+        ok = playable_ids(sp, ids, MARKET)
+        RUN["exclusions"]["unplayable"] += len(ids) - len(ok)
+        return ok
+
+    # a playlist can hold the same track twice; dedupe here so the buckets below stay disjoint.
+    # An unplayable carry track just shrinks carry; discovery's share grows to match.
+    current_unique = uniq(current_ids)
+    RUN["counts"]["deduped"] = len(current_ids) - len(current_unique)
+    carry = keep_playable(current_unique[:carry_n])
     RUN["counts"]["carry"] = len(carry)
     RUN["debug_samples"]["carry"] = carry[:10]
     event("carry", count=len(carry))
 
-    # 2) Familiar (60%)
-    familiar_target = max(0, int(round(N_TRACKS * FAMILIAR_RATIO)))
-    familiar_ids = build_familiar(sp, carry, familiar_target)
-    RUN["counts"]["familiar"] = len(familiar_ids)
-    RUN["debug_samples"]["familiar"] = familiar_ids[:10]
-    event("familiar_pick", count=len(familiar_ids))
-
-    # 3) Discovery (40%) – novelty enforced vs seen.json
-    need = max(0, N_TRACKS - len(carry) - len(familiar_ids))
     # Seeds for discovery from user tastes
-    top_art   = current_user_top_artists(sp, "short_term") + current_user_top_artists(sp, "medium_term")
-    top_tracks= (current_ids[:20] or []) + current_user_top(sp, "short_term")[:20]
+    top_art   = f_art_short.result()
+    # recs() only uses 3 artist seeds: medium_term is a fallback, not a second fetch every run
+    if len(uniq(top_art)) < 3:
+        top_art += current_user_top_artists(sp, "medium_term")
+    top_tracks= (current_ids[:20] or []) + top_short[:20]
     top_art = uniq(top_art)
     top_tracks = uniq(top_tracks)
     RUN["seeds"]["artists"] = top_art[:10]
     RUN["seeds"]["tracks"]  = top_tracks[:10]
 
+    # Primary recommendations only depend on seeds: start them now so their
+    # round trips overlap the familiar build and seen-log read below
+    familiar_target = max(0, int(round(N_TRACKS * FAMILIAR_RATIO)))
+    discovery_target = max(N_TRACKS - len(carry) - familiar_target, 10)
+    bg = ThreadPoolExecutor(max_workers=1)
+    f_recs = bg.submit(recs, sp, discovery_target * 2, top_art, top_tracks,
+                       (MIN_ENERGY, MAX_ENERGY), (MIN_TEMPO, MAX_TEMPO), MARKET)
+    bg.shutdown(wait=False)
+
+    # 2) Familiar (60%)
+    familiar_ids = build_familiar(carry, familiar_target, top_short, f_top_med.result(), f_saved.result(),
+                                  keep=keep_playable)
+    RUN["counts"]["familiar"] = len(familiar_ids)
+    RUN["debug_samples"]["familiar"] = familiar_ids[:10]
+    event("familiar_pick", count=len(familiar_ids))
+
+    # 3) Discovery (40%) – novelty enforced vs seen.ndjson
+    need = max(0, N_TRACKS - len(carry) - len(familiar_ids))
     avoid: Set[str] = set(carry) | set(familiar_ids)
     # Load seen memory
-    seen_list = load_seen()
-    seen: Set[str] = set(seen_list)
-    discovery_pool = build_discovery(sp, top_art, top_tracks, avoid_ids=avoid | seen, target_n=max(need, 10))
+    seen_runs, seen = load_seen()
+    # seen is not needed on its own again: fold avoid into it in place rather than copying ~SEEN_MAX IDs
+    seen.update(avoid)
+    primary = f_recs.result()
+    discovery_pool = build_discovery(sp, top_art, top_tracks, avoid_ids=seen, target_n=max(need, 10),
+                                     primary=primary, keep=keep_playable)
     discovery_ids = discovery_pool[:need]
     # If still short, allow partial overlap with seen (very mild) to fill up
     if len(discovery_ids) < need:
         shortfall = need - len(discovery_ids)
-        backfill = [t for t in build_discovery(sp, top_art, top_tracks, avoid_ids=avoid, target_n=shortfall*2)
-                    if t not in avoid][:shortfall]
+        # same seeds and window as above: reuse the primary recs (now minus only avoid + picks)
+        # rather than asking for them again; catalog fallbacks are memoised in-process
+        avoid.update(discovery_ids)
+        backfill = build_discovery(sp, top_art, top_tracks, avoid_ids=avoid,
+                                   target_n=shortfall*2, primary=primary, keep=keep_playable)[:shortfall]
         discovery_ids.extend(backfill)
 
     RUN["counts"]["discovery"] = len(discovery_ids)
@@ -462,51 +839,36 @@ def main() -> int:
     RUN["debug_samples"]["discovery_pick"] = discovery_ids[:10]
     event("discovery_pick", count=len(discovery_ids))
 
-    # 4) Merge, dedupe, cap
-    ordered = uniq(carry + familiar_ids + discovery_ids)[:N_TRACKS]
+    # 4) Merge, cap
+    # buckets are disjoint by construction (familiar skips carry, discovery/backfill skip both)
+    # and already playable in MARKET (filtered before sampling)
+    merged = carry + familiar_ids + discovery_ids
+    ordered = merged[:N_TRACKS]
     RUN["counts"]["final"] = len(ordered)
-    RUN["counts"]["deduped"] = (len(carry) + len(familiar_ids) + len(discovery_ids)) - len(ordered)
     RUN["debug_samples"]["final"] = ordered[:10]
     RUN["final_track_ids"] = ordered[:]
-    # Source tags for CSV
-    final_sources: List[Tuple[str, str]] = []
-    s_carry = set(carry); s_fam = set(familiar_ids); s_dis = set(discovery_ids)
-    for tid in ordered:
-        if tid in s_carry:      final_sources.append((tid, "carry"))
-        elif tid in s_fam:      final_sources.append((tid, "familiar"))
-        elif tid in s_dis:      final_sources.append((tid, "discovery"))
-        else:                   final_sources.append((tid, "other"))
+    # Source tags for CSV: one id -> bucket map, later updates win (carry > familiar > discovery)
+    bucket_of: Dict[str, str] = dict.fromkeys(discovery_ids, "discovery")
+    bucket_of.update(dict.fromkeys(familiar_ids, "familiar"))
+    bucket_of.update(dict.fromkeys(carry, "carry"))
+    final_sources: List[Tuple[str, str]] = [(tid, bucket_of.get(tid, "other")) for tid in ordered]
 
     RUN["_final_sources"] = final_sources  # internal for CSV write
 
-    # 5) Write playlist (replace)
-    uris = [f"spotify:track:{tid}" for tid in ordered]
-    try:
-        sp.playlist_replace_items(PLAYLIST_ID, uris)
-    except Exception as e:
-        warn_api("playlist_replace_items", e)
-        # Try slow path: clear + add in chunks
-        try:
-            sp.playlist_remove_all_occurrences_of_items(PLAYLIST_ID, [{"uri": u} for u in uris])
-        except Exception as e2:
-            warn_api("playlist_remove_all_occurrences_of_items", e2)
-        # add back
-        i = 0
-        while i < len(uris):
-            try:
-                sp.playlist_add_items(PLAYLIST_ID, uris[i:i+100])
-            except Exception as e3:
-                warn_api("playlist_add_items", e3)
-                break
-            i += 100
+    # 5) Write playlist (replace) — spotipy turns bare IDs into track URIs itself
+    # Identical tracklist: skip the write RTT and keep the playlist snapshot_id (and client caches) intact
+    if ordered == current_ids:
+        log.info("Playlist unchanged; skipping write")
+        event("write", skipped=True)
+    else:
+        write_playlist(sp, PLAYLIST_ID, ordered)
 
     # 6) Persist memory (seen + history), then write reports
     # Update seen with everything we *attempted* to add this run
-    new_seen = uniq(seen_list + ordered)
-    save_seen(new_seen)
+    save_seen(seen_runs, {"ts": RUN["started_utc"], "tracks": ordered, "n": len(ordered)})
     append_history(RUN_TS, ordered, final_sources)
 
-    print(f"OK: wrote {len(ordered)} tracks to {PLAYLIST_ID} at {datetime.datetime.utcnow().isoformat()}Z. "
+    print(f"OK: wrote {len(ordered)} tracks to {PLAYLIST_ID} at {iso_z(utc_now())}. "
           f"Window={{'tempo': ({MIN_TEMPO},{MAX_TEMPO}), 'energy': ({MIN_ENERGY},{MAX_ENERGY}), 'familiar_ratio': {FAMILIAR_RATIO}}}")
 
     return 0